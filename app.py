@@ -1,37 +1,58 @@
 """app.py
 
 TODOs:
-- Do not overwrite files with the same name
 - Add tests to checksum uploaded files
 - Better/custom text filenames
 
 """
 
-import base64
+import errno
+import functools
+import html
 import http
 import http.server
+import io
 import mimetypes
 import os
+import queue
 import re
 import secrets
-import shutil
+import selectors
+import socket
+import stat
 import sys
-import tempfile
+import threading
 import urllib.parse
 
 PORT = 8080
 FILEDIR = "tmp"
+CHUNK_SIZE = 64 * 1024
+MAX_HEADER_SIZE = 16 * 1024
+MAX_TEXT_SIZE = 1024 * 1024
+MAX_UPLOAD_SIZE = 16 * 1024 * 1024 * 1024
+MAX_PARTS = 1000
+SEND_BUFFER_SIZE = 4 * 1024 * 1024
+COPY_CHUNK_SIZE = 1024 * 1024
+BYTE_UNITS = ("B", "K", "M", "G")
+BYTE_RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)")
 
+# Errors from os.sendfile meaning the file or socket is not supported
+SENDFILE_UNSUPPORTED_ERRNOS = (errno.EINVAL, errno.ENOTSUP, errno.EOPNOTSUPP)
+
+# Errors from os.link meaning the filesystem has no hard links
+LINK_UNSUPPORTED_ERRNOS = (errno.EPERM, errno.EINVAL, errno.ENOTSUP, errno.EOPNOTSUPP)
+
+# Requests are I/O bound, so use more threads than cores
+MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+REQUEST_TIMEOUT = 60
+
+# Rendered homepage, keyed on the st_mtime_ns of FILEDIR
+HOMEPAGE_CACHE = {"mtime": -1, "body": b""}
+HOMEPAGE_CACHE_LOCK = threading.Lock()
 
-def render_homepage_html(file_data=None):
-    """render_homepage_html renders templates HTML for the app"""
-    uploaded_files_html = ""
-    for fd in file_data:
-        name, size = fd["filename"], human_bytes(fd["filesize"])
-        row = f'<tr><td><a href="/upload/{name}">{name}</a></td><td>{size}</td></tr>'
-        uploaded_files_html += row
 
-    return f"""
+# Static HTML around the uploaded files table, encoded once
+HOMEPAGE_HEAD = """
 <!doctype html>
 <html lang="en">
   <head>
@@ -39,18 +60,18 @@ def render_homepage_html(file_data=None):
     <meta name="viewport" content="width=device-width, initial-scale=1" />
     <title>PyFile</title>
     <style>
-    * {{ margin 0; padding: 0; }}
-    body {{ margin: 10px auto; max-width: 80ch; font-family: sans-serif; font-size: 100%; }}
-    main {{ margin: 0 20px; }}
-    h1 {{ font-size: 26px; }}
-    form {{ display: flex; flex-direction: column; gap: 10px; }}
-    fieldset {{ display: flex; justify-content: space-between; border: none;}}
-    textarea {{ padding: 10px; min-height: 80px; resize: vertical; text-wrap: nowrap; font-size: 16px; font-family: monospace; }}
-    input[name="submit"] {{ margin: 0 auto; padding: 0 10px; }}
-    table {{ margin: 20px 0; padding: 10px 0; border-top: 1px solid #888; width: 100%; border-spacing: 0 6px; font-family: monospace; font-size: 16px; }}
-    table th:nth-child(1), td:nth-child(1) {{ text-align: left; }}
-    table th:nth-child(2), td:nth-child(2) {{ text-align: right; }}
-    tbody tr:hover {{ background-color: #f9f9f9; }}
+    * { margin 0; padding: 0; }
+    body { margin: 10px auto; max-width: 80ch; font-family: sans-serif; font-size: 100%; }
+    main { margin: 0 20px; }
+    h1 { font-size: 26px; }
+    form { display: flex; flex-direction: column; gap: 10px; }
+    fieldset { display: flex; justify-content: space-between; border: none;}
+    textarea { padding: 10px; min-height: 80px; resize: vertical; text-wrap: nowrap; font-size: 16px; font-family: monospace; }
+    input[name="submit"] { margin: 0 auto; padding: 0 10px; }
+    table { margin: 20px 0; padding: 10px 0; border-top: 1px solid #888; width: 100%; border-spacing: 0 6px; font-family: monospace; font-size: 16px; }
+    table th:nth-child(1), td:nth-child(1) { text-align: left; }
+    table th:nth-child(2), td:nth-child(2) { text-align: right; }
+    tbody tr:hover { background-color: #f9f9f9; }
     </style>
   </head>
 
@@ -67,55 +88,176 @@ def render_homepage_html(file_data=None):
 
       <table>
         <thead><tr><th>File</th><th>Size</th></tr></thead>
-        <tbody>{uploaded_files_html}</tbody>
+        <tbody>""".encode("utf-8")
+
+HOMEPAGE_TAIL = """</tbody>
       </table>
     </main>
   </body>
 </html>
-""".encode(
-        "utf-8"
-    )
+""".encode("utf-8")
+
+
+def render_homepage_html(file_data=None):
+    """render_homepage_html renders templates HTML for the app"""
+    chunks = [HOMEPAGE_HEAD]
+    for _, filename, filesize in file_data:
+        href = urllib.parse.quote(filename)
+        name, size = html.escape(filename), human_bytes(filesize)
+        row = f'<tr><td><a href="/upload/{href}">{name}</a></td><td>{size}</td></tr>'
+        chunks.append(row.encode("utf-8"))
+    chunks.append(HOMEPAGE_TAIL)
+
+    # Join once so the page is copied into a single bytes object
+    return b"".join(chunks)
 
 
 def human_bytes(num):
     """human_bytes rounds bytes to the nearest human friendly unit"""
-    for unit in ("B", "K", "M", "G"):
-        if abs(num) < 1024.0:
-            return f"{num:3.1f}{unit}"
-        num /= 1024.0
-    return "?"
+    # Each unit is 10 more bits than the last
+    i = (abs(num).bit_length() - 1) // 10 if num else 0
+    if i >= len(BYTE_UNITS):
+        return "?"
+    return f"{num / (1 << i * 10):3.1f}{BYTE_UNITS[i]}"
 
 
 def get_uploaded_file_data(path=FILEDIR):
-    """get_uploaded_file_data returns a list of file uploads"""
+    """get_uploaded_file_data returns a list of (path, filename,
+    filesize) tuples for each file upload"""
 
-    file_data = []
+    # Avoid following symlinks so scandir's cached stat is used
     with os.scandir(path) as uploads:
-        for entry in uploads:
-            if not entry.name.startswith(".") and entry.is_file():
-                file_data.append(
-                    {
-                        "path": entry.path,
-                        "filename": entry.name,
-                        "filesize": entry.stat().st_size,
-                    }
-                )
+        return [
+            (entry.path, entry.name, entry.stat(follow_symlinks=False).st_size)
+            for entry in uploads
+            if not entry.name.startswith(".") and entry.is_file(follow_symlinks=False)
+        ]
+
+
+def get_uploaded_file(filename, path=FILEDIR):
+    """get_uploaded_file returns a (path, filename, filesize) tuple for
+    the file upload named filename, or None if there is no such upload"""
 
-    return file_data
+    # Only allow names that get_uploaded_file_data would list
+    if filename.startswith(".") or os.path.basename(filename) != filename:
+        return None
 
+    filepath = os.path.join(path, filename)
+    try:
+        st = os.lstat(filepath)
+    except (OSError, ValueError):
+        return None
+
+    if not stat.S_ISREG(st.st_mode):
+        return None
+
+    return filepath, filename, st.st_size
+
+
+def get_byte_range(header, size):
+    """get_byte_range returns the (start, end) offsets of a file of size
+    bytes requested by a Range header such as bytes=start-end, or None
+    to send the whole file. It raises ValueError for ranges that cannot
+    be satisfied."""
+
+    if header is None:
+        return None
+
+    # Ignore multiple or malformed ranges
+    m = BYTE_RANGE_RE.fullmatch(header.strip())
+    if m is None or m.groups() == ("", ""):
+        return None
+
+    first, last = m.groups()
+    if first == "":
+        # Suffix range of the last bytes
+        suffix = int(last)
+        if suffix == 0 or size == 0:
+            raise ValueError(f"unsatisfiable range: {header}")
+        return max(size - suffix, 0), size
+
+    start = int(first)
+    end = int(last) + 1 if last else size
+    if start >= size:
+        raise ValueError(f"unsatisfiable range: {header}")
+    if end <= start:
+        return None
+    return start, min(end, size)
+
+
+def save_upload(upload, path=FILEDIR):
+    """save_upload moves a finished upload into place under its filename.
+    Text form content held in memory is saved to a new file unless it is
+    empty. Uploads are not fsynced, so durability is left to the OS."""
+    if isinstance(upload, io.BytesIO):
+        buf = upload
+        if buf.tell() == 0:
+            buf.close()
+            return
+        upload = UploadFile(f"text_{rand_hex_str()}.txt", path)
+        try:
+            upload.write(buf.getbuffer())
+            upload.save()
+        except BaseException:
+            # Discard the temporary file, which do_POST cannot see
+            upload.close()
+            raise
+        finally:
+            buf.close()
+        return
 
-def rand_b32_str(n=5):
-    """rand_b32_str returns a random string of base32 encoded bytes"""
-    b = base64.b32encode(secrets.token_bytes(n))
-    return b.decode("utf-8").lower()
+    upload.save()
+
+
+@functools.lru_cache(maxsize=16)
+def can_link_tmpfile(path):
+    """can_link_tmpfile reports whether an unnamed O_TMPFILE file in path
+    can be linked into place through /proc, which is Linux only and not
+    supported by every filesystem"""
+    if not hasattr(os, "O_TMPFILE"):
+        return False
+
+    probe = os.path.join(path, f".{rand_hex_str()}.probe")
+    try:
+        fd = os.open(path, os.O_TMPFILE | os.O_WRONLY, 0o666)
+        try:
+            os.link(f"/proc/self/fd/{fd}", probe, follow_symlinks=True)
+            os.unlink(probe)
+        finally:
+            os.close(fd)
+    except OSError:
+        return False
+    return True
+
+
+def rename_new(src, dst):
+    """rename_new renames src to dst unless dst already exists. dst is
+    reserved with O_EXCL first, so it is briefly an empty file."""
+    os.close(os.open(dst, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+    try:
+        os.replace(src, dst)
+    except BaseException:
+        os.unlink(dst)
+        raise
+
+
+def rand_hex_str(n=5):
+    """rand_hex_str returns a random string of n hex encoded bytes"""
+    return secrets.token_hex(n)
+
+
+@functools.lru_cache(maxsize=16)
+def get_header_opt_re(key):
+    """get_header_opt_re returns the compiled pattern for get_header_opt"""
+    key = re.escape(key)
+    return re.compile(rf'{key}=([^\s";]+)|{key}="([^"]+)"')
 
 
 def get_header_opt(key, header):
     """get_header_opt returns the value from a quoted or unquoted HTTP
     header piece such as key="value" or key=value"""
 
-    p = re.compile(rf'{key}=([^\s";]+)|{key}="([^"]+)"')
-    m = p.search(header)
+    m = get_header_opt_re(key).search(header)
     if m is None:
         return ""
 
@@ -125,74 +267,184 @@ def get_header_opt(key, header):
     return b.strip()
 
 
+def read_chunks(f, size, chunk_size=CHUNK_SIZE):
+    """read_chunks yields blocks of up to chunk_size from the next size
+    bytes of f"""
+    while size > 0:
+        chunk = f.read(min(chunk_size, size))
+        if not chunk:
+            return
+        size -= len(chunk)
+        yield chunk
+
+
 def parse_multipart(req_headers, req_body):
     """parse_multipart parses a multipart/form-data request body and
-    returns a dict containing each upload file"""
-
-    content_type = req_headers["Content-Type"]
+    yields (form_name, filename, chunk) tuples for each upload. The
+    first tuple of every part has a chunk of None. Chunks are
+    memoryviews that are released once the next tuple is read. It raises
+    ValueError for malformed bodies, including ones that end before the
+    closing boundary."""
+
+    content_type = req_headers.get("Content-Type", "")
+    content_length = int(req_headers.get("Content-Length", 0))
     boundary = get_header_opt("boundary", content_type)
-    separator = f"--{boundary}\r\n".encode("utf-8")
-    terminator = f"--{boundary}--\r\n".encode("utf-8")
+    if boundary == "":
+        raise ValueError("multipart body has no boundary")
+    delimiter = f"\r\n--{boundary}".encode("utf-8")
+    chunks = read_chunks(req_body, content_length)
+
+    # Keep enough bytes to match a delimiter split across reads
+    keep = len(delimiter) - 1
 
-    multipart_form_data = []
+    # Prefix CRLF so the first boundary matches the delimiter. The
+    # window is only trimmed from the front, which bytearray does in place
+    window = bytearray(b"\r\n")
+    window += next(chunks, b"")
 
     # Look for the first file
     while True:
-        if req_body.readline() == separator:
+        i = window.find(delimiter)
+        if i != -1:
+            del window[:i]
             break
+        chunk = next(chunks, b"")
+        if not chunk:
+            raise ValueError("multipart body has no boundary")
+        del window[:-keep]
+        window += chunk
 
     # Read multipart data
     while True:
-        line = req_body.readline()
-        if not line.startswith(b"Content-Disposition:"):
-            continue
-
-        header = line.rstrip().decode("utf-8")
-        form_name = get_header_opt("name", header)
-        filename = get_header_opt("filename", header)
-
-        # Use temp file as a bytes buffer
-        buf = tempfile.TemporaryFile(mode="w+b")
-
         # Read until end of headers
         while True:
-            line = req_body.readline()
-            if line == b"\r\n":
+            # Closing --boundary--
+            if window.startswith(b"--", len(delimiter)):
+                return
+            end = window.find(b"\r\n\r\n", len(delimiter))
+            if end != -1:
                 break
-
-        # Read file content into buffer
+            if len(window) > len(delimiter) + MAX_HEADER_SIZE:
+                raise ValueError(f"multipart headers over {MAX_HEADER_SIZE} bytes")
+            chunk = next(chunks, b"")
+            if not chunk:
+                raise ValueError("multipart body ended in part headers")
+            window += chunk
+
+        form_name, filename = "", ""
+        for header in window[len(delimiter) : end].decode("utf-8").split("\r\n"):
+            if header.startswith("Content-Disposition:"):
+                form_name = get_header_opt("name", header)
+                filename = get_header_opt("filename", header)
+        yield form_name, filename, None
+        del window[: end + 4]
+
+        # Stream file content up to the next boundary
         while True:
-            line = req_body.readline()
-            if line in (separator, terminator):
+            i = window.find(delimiter)
+            if i != -1:
                 break
-            buf.write(line)
-
-        multipart_form_data.append(
-            {
-                "form_name": form_name,
-                "filename": filename,
-                "buf": buf,
-            }
-        )
-
-        # Check if done
-        if line == terminator:
-            # Remove trailing CRLF from HTTP
-            buf.seek(-2, 2)
-            buf.truncate()
-            break
+            if len(window) > keep:
+                with memoryview(window)[:-keep] as chunk:
+                    yield form_name, filename, chunk
+                del window[:-keep]
+            chunk = next(chunks, b"")
+            if not chunk:
+                raise ValueError("multipart body ended before its boundary")
+            window += chunk
+
+        if i > 0:
+            with memoryview(window)[:i] as chunk:
+                yield form_name, filename, chunk
+        del window[:i]
+
+
+class UploadFile(io.BufferedWriter):
+    """UploadFile writes an upload to a hidden temporary file in path,
+    which only appears under filename once it is saved"""
+
+    def __init__(self, filename, path=FILEDIR):
+        self.filename, self.dirpath, self.tmp_path = filename, path, None
+        flags = os.O_WRONLY | getattr(os, "O_BINARY", 0)
+        if can_link_tmpfile(path):
+            # Unnamed file that vanishes if the upload is never saved
+            fd = os.open(path, flags | os.O_TMPFILE, 0o666)
+        else:
+            self.tmp_path = os.path.join(path, f".{rand_hex_str()}.part")
+            fd = os.open(self.tmp_path, flags | os.O_CREAT | os.O_EXCL, 0o666)
+        super().__init__(io.FileIO(fd, "wb"))
+
+    def save(self):
+        """save moves the file into place as filename, or as a new name
+        if filename is taken, and closes it"""
+        if self.tmp_path is None:
+            # The unnamed file can only be linked while it is open
+            self.flush()
+            self.place(f"/proc/self/fd/{self.fileno()}", os.link)
+            self.close()
+            return
 
-    # Done
-    return multipart_form_data
+        # Close without discarding the temporary file
+        super().close()
+        try:
+            self.place(self.tmp_path, os.link)
+        except OSError as e:
+            if e.errno not in LINK_UNSUPPORTED_ERRNOS:
+                raise
+            # Filesystem without hard links
+            self.place(self.tmp_path, rename_new)
+            self.tmp_path = None
+        finally:
+            self.close()
+
+    def place(self, src, move):
+        """place moves src into the upload directory with move(src, dst),
+        trying new names while move raises FileExistsError"""
+        name = self.filename
+        while True:
+            try:
+                move(src, os.path.join(self.dirpath, name))
+                return
+            except FileExistsError:
+                stem, ext = os.path.splitext(self.filename)
+                name = f"{stem}_{rand_hex_str()}{ext}"
+
+    def close(self):
+        """close closes the file, discarding it if it was never saved"""
+        super().close()
+        if self.tmp_path is not None:
+            try:
+                os.unlink(self.tmp_path)
+            except FileNotFoundError:
+                pass
+            self.tmp_path = None
 
 
 class AppHandler(http.server.BaseHTTPRequestHandler):
     """AppHandler handles all web requests"""
 
+    # Send headers without waiting on Nagle's algorithm
+    disable_nagle_algorithm = True
+
+    # Drop idle clients so they cannot hold a worker forever
+    timeout = REQUEST_TIMEOUT
+
+    # Cleared for the connection if sendfile does not support its sockets
+    use_sendfile = hasattr(os, "sendfile")
+
     def do_GET(self):
         """do_GET handles GET requests"""
+        self.send_resource()
+
+    def do_HEAD(self):
+        """do_HEAD handles HEAD requests without reading any file"""
+        self.send_resource(content=False)
+
+    def send_resource(self, content=True):
+        """send_resource sends the page or file upload at the request
+        path, leaving out the body unless content is set"""
         if self.path == "/":
-            self.send_homepage()
+            self.send_homepage(content)
             return
 
         if not self.path.startswith("/upload/"):
@@ -200,19 +452,14 @@ class AppHandler(http.server.BaseHTTPRequestHandler):
             return
 
         url = urllib.parse.urlparse(self.path)
-        _, basename = urllib.parse.unquote(url.path).split("/upload/")
-
-        upload = None
-        for ufd in get_uploaded_file_data():
-            if basename == ufd["filename"]:
-                upload = ufd
-                break
+        basename = urllib.parse.unquote(url.path).removeprefix("/upload/")
 
+        upload = get_uploaded_file(basename)
         if upload is None:
             self.send_error(http.HTTPStatus.NOT_FOUND)
             return
 
-        self.send_filedata(upload)
+        self.send_filedata(upload, content)
 
     def do_POST(self):
         """do_POST handles POST requests"""
@@ -220,57 +467,178 @@ class AppHandler(http.server.BaseHTTPRequestHandler):
             self.send_error(http.HTTPStatus.NOT_IMPLEMENTED)
             return
 
-        multipart_form_data = parse_multipart(self.headers, self.rfile)
+        # Reject bad or oversized uploads before reading any of the body
+        content_type = self.headers.get("Content-Type", "")
+        if not content_type.lower().startswith("multipart/form-data") or (
+            get_header_opt("boundary", content_type) == ""
+        ):
+            self.send_error(http.HTTPStatus.BAD_REQUEST)
+            return
+        try:
+            content_length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            self.send_error(http.HTTPStatus.BAD_REQUEST)
+            return
+        if content_length > MAX_UPLOAD_SIZE:
+            self.send_error(http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+            return
 
-        for part in multipart_form_data:
-            filename, buf = part["filename"], part["buf"]
-            match part["form_name"]:
-                case "files":
-                    if filename == "":
-                        continue
-                case "text":
-                    # Skip empty form
-                    if buf.tell() == 0:
-                        continue
-                    filename = f"text_{rand_b32_str()}.txt"
-                case _:
+        upload, parts = None, 0
+        try:
+            for form_name, filename, chunk in parse_multipart(self.headers, self.rfile):
+                # Start of a new part
+                if chunk is None:
+                    if upload is not None:
+                        save_upload(upload)
+                    upload = None
+
+                    parts += 1
+                    if parts > MAX_PARTS:
+                        self.send_error(http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+                        return
+
+                    match form_name:
+                        case "files":
+                            # Never write outside of FILEDIR
+                            filename = os.path.basename(filename)
+                            if filename != "":
+                                upload = UploadFile(filename)
+                        case "text":
+                            # Text is small, so keep it in memory
+                            upload = io.BytesIO()
                     continue
 
-            # Save uploaded files
-            with open(f"{FILEDIR}/{filename}", "wb") as f:
-                buf.seek(0)
-                f.write(buf.read())
-            buf.close()
+                if upload is None:
+                    continue
+
+                # Save uploaded files
+                upload.write(chunk)
+                if form_name == "text" and upload.tell() > MAX_TEXT_SIZE:
+                    self.send_error(http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+                    return
+
+            if upload is not None:
+                save_upload(upload)
+                upload = None
+        except ValueError:
+            self.send_error(http.HTTPStatus.BAD_REQUEST)
+            return
+        finally:
+            # Discard any unfinished upload
+            if upload is not None:
+                upload.close()
+
+            # Directory mtimes may be too coarse to show every change
+            with HOMEPAGE_CACHE_LOCK:
+                HOMEPAGE_CACHE["mtime"] = -1
 
         # Done
         self.send_redirect("/")
 
-    def send_homepage(self):
-        """send_homepage sends the homepage to the client"""
-        file_data = get_uploaded_file_data()
-        self.send_bytes(render_homepage_html(file_data), "text/html")
-
-    def send_filedata(self, filedata):
-        """send_filedata sends filedata to the client"""
-        ctype, _ = mimetypes.guess_type(filedata["filename"])
+    def send_homepage(self, content=True):
+        """send_homepage sends the homepage to the client, re-rendering
+        it only when FILEDIR has changed"""
+        mtime = os.stat(FILEDIR).st_mtime_ns
+        with HOMEPAGE_CACHE_LOCK:
+            if HOMEPAGE_CACHE["mtime"] != mtime:
+                file_data = get_uploaded_file_data()
+                HOMEPAGE_CACHE["body"] = render_homepage_html(file_data)
+                HOMEPAGE_CACHE["mtime"] = mtime
+            body = HOMEPAGE_CACHE["body"]
+
+        self.send_bytes(body, "text/html", content)
+
+    def send_filedata(self, filedata, content=True):
+        """send_filedata sends filedata, or the part of it requested by
+        a Range header, to the client"""
+        path, filename, size = filedata
+        ctype, _ = mimetypes.guess_type(filename)
         if not ctype:
             ctype = "application/octet-stream"
 
-        self.send_response(http.HTTPStatus.OK)
+        try:
+            byte_range = get_byte_range(self.headers.get("Range"), size)
+        except ValueError:
+            self.send_response(http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", 0)
+            self.end_headers()
+            return
+
+        if byte_range is None:
+            start, end = 0, size
+            self.send_response(http.HTTPStatus.OK)
+        else:
+            start, end = byte_range
+            self.send_response(http.HTTPStatus.PARTIAL_CONTENT)
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+
+        self.send_header("Accept-Ranges", "bytes")
         self.send_header("Content-Type", ctype)
-        self.send_header("Content-Length", filedata["filesize"])
+        self.send_header("Content-Length", end - start)
         self.end_headers()
+        if not content:
+            return
 
-        with open(filedata["path"], "rb") as f:
-            shutil.copyfileobj(f, self.wfile)
+        with open(path, "rb") as f:
+            f.seek(start)
+            if self.use_sendfile:
+                # Flush buffered headers before writing to the socket
+                self.wfile.flush()
+                try:
+                    self.sendfile(f, end)
+                    return
+                except OSError as e:
+                    if e.errno not in SENDFILE_UNSUPPORTED_ERRNOS:
+                        raise
+                    # Stop trying sendfile for this connection
+                    self.use_sendfile = False
+            # Resume from wherever sendfile left off
+            self.copyfile(f, end)
+
+    def sendfile(self, f, end):
+        """sendfile copies f to the client up to offset end using
+        zero-copy os.sendfile"""
+        sock_fd, file_fd = self.connection.fileno(), f.fileno()
+        timeout = self.connection.gettimeout()
+        offset = f.tell()
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(sock_fd, selectors.EVENT_WRITE)
+                while offset < end:
+                    try:
+                        sent = os.sendfile(sock_fd, file_fd, offset, end - offset)
+                    except BlockingIOError:
+                        # Sockets with a timeout are non-blocking, so wait
+                        # for the send buffer to drain
+                        if not selector.select(timeout):
+                            raise TimeoutError("timed out sending file")
+                        continue
+                    if sent == 0:
+                        break
+                    offset += sent
+        finally:
+            # os.sendfile does not move the file position
+            f.seek(offset)
+
+    def copyfile(self, f, end):
+        """copyfile copies f to the client up to offset end"""
+        remaining = end - f.tell()
+        while remaining > 0:
+            chunk = f.read(min(COPY_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
 
-    def send_bytes(self, body, mime="text/plain"):
+    def send_bytes(self, body, mime="text/plain", content=True):
         """send_bytes sends bytes to the client"""
         self.send_response(http.HTTPStatus.OK)
         self.send_header("Content-Type", mime)
         self.send_header("Content-Length", len(body))
         self.end_headers()
-        self.wfile.write(body)
+        if content:
+            self.wfile.write(body)
 
     def send_redirect(self, loc):
         """send_redirect sends a redirect to the client"""
@@ -281,10 +649,61 @@ class AppHandler(http.server.BaseHTTPRequestHandler):
         self.end_headers()
 
 
+class PooledHTTPServer(http.server.HTTPServer):
+    """PooledHTTPServer handles requests in a fixed pool of daemon worker
+    threads, which are reused across connections and never keep the
+    process from exiting"""
+
+    def __init__(self, *args, max_workers=MAX_WORKERS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requests = queue.SimpleQueue()
+        self.workers = [
+            threading.Thread(target=self.process_requests, daemon=True)
+            for _ in range(max_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def get_request(self):
+        """get_request accepts a connection with a larger send buffer
+        for downloads"""
+        request, client_address = super().get_request()
+        request.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+        return request, client_address
+
+    def process_request(self, request, client_address):
+        """process_request queues the request for a worker thread without
+        blocking serve_forever"""
+        self.requests.put((request, client_address))
+
+    def process_requests(self):
+        """process_requests handles queued requests in a worker thread
+        until the server is closed"""
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        """server_close closes the server and stops its workers once the
+        queued requests are handled"""
+        super().server_close()
+        for _ in self.workers:
+            self.requests.put(None)
+
+
 if __name__ == "__main__":
     os.makedirs(FILEDIR, exist_ok=True)
 
-    httpd = http.server.ThreadingHTTPServer(("", PORT), AppHandler)
+    httpd = PooledHTTPServer(("", PORT), AppHandler)
     host, port = httpd.socket.getsockname()[:2]
 
     info = f"Serving at http://{host}:{port}/ ..."